@@ -0,0 +1,349 @@
+"""Shared XADF parsing and data-shaping helpers for the Streamlit viewers."""
+import streamlit as st
+try:
+    from lxml import etree as ET
+    HAVE_LXML=True
+except ImportError:  # fall back to the stdlib (C-accelerated) ElementTree
+    import xml.etree.ElementTree as ET
+    HAVE_LXML=False
+import io
+import json
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib json encoder
+    orjson=None
+import pandas as pd
+import pyarrow as pa
+
+# ---------- helpers ----------
+# indexed by Z (slot 0 unused) / by line id (None = unnamed line)
+ELEMENTS = (None,
+"H","He","Li","Be","B","C","N","O","F","Ne","Na","Mg","Al","Si","P","S","Cl","Ar",
+"K","Ca","Sc","Ti","V","Cr","Mn","Fe","Co","Ni","Cu","Zn","Ga","Ge","As","Se","Br","Kr",
+"Rb","Sr","Y","Zr","Nb","Mo","Tc","Ru","Rh","Pd","Ag","Cd","In","Sn","Sb","Te","I","Xe",
+"Cs","Ba","La","Ce","Pr","Nd","Pm","Sm","Eu","Gd","Tb","Dy","Ho","Er","Tm","Yb","Lu",
+"Hf","Ta","W","Re","Os","Ir","Pt","Au","Hg","Tl","Pb","Bi","Po","At","Rn","Fr","Ra","Ac",
+"Th","Pa","U"
+)
+LINE_MAP = (None,None,None,"K_alpha1","K_alpha2","K_beta2","K_beta1",None,"K_beta3","K_beta5",
+            None,None,"L_alpha1",None,"L_beta1","L_beta2",None,"L_gamma1")
+ATMOSPHERE_MAP = {"0":"Vacuum","1":"Air","2":"Helium"}
+
+def element_symbol(z):
+    z=int(z)
+    return ELEMENTS[z] if 0<z<len(ELEMENTS) else "?"
+
+def line_name(x):
+    i=int(x)
+    return (LINE_MAP[i] if 0<=i<len(LINE_MAP) else None) or f"Line{x}"
+
+def translate_used_lines(s):
+    if not s: return []
+    try: return [line_name(x) for x in s.split(",") if x.strip()]
+    except: return []
+
+def dumps_json(obj):
+    # indented UTF-8 JSON bytes for st.download_button
+    if orjson is not None: return orjson.dumps(obj,option=orjson.OPT_INDENT_2)
+    return json.dumps(obj,indent=2,ensure_ascii=False).encode("utf-8")
+
+CLASS_INSTANCE="ClassInstance"
+
+def element_to_dict(elem):
+    # explicit work list instead of recursion: child dicts are placed first, then filled when popped
+    out={}; stack=[(elem,out)]
+    while stack:
+        node,d=stack.pop()
+        for c in node:
+            if c.tag==CLASS_INSTANCE:
+                for sub in c:
+                    d[sub.tag]=sd={}; stack.append((sub,sd))
+            elif len(c):
+                d[c.tag]=sd={}; stack.append((c,sd))
+            else:
+                d[c.tag]=c.text.strip() if c.text else None
+    return out
+
+def leaf_value(node):
+    return element_to_dict(node) if len(node) else (node.text.strip() if node.text else None)
+
+def child_fields(node):
+    # direct children keyed by tag, with ClassInstance wrappers flattened like element_to_dict
+    f={}
+    for c in node:
+        if c.tag==CLASS_INSTANCE:
+            for sub in c: f[sub.tag]=sub
+        else: f[c.tag]=c
+    return f
+
+def extract_single_layer(elem):
+    """Read only the layer fields the summary uses instead of lifting the whole subtree."""
+    fields=child_fields(elem)
+    d=next(iter(fields.values()),None)
+    if d is None or not len(d): return {}
+    f=child_fields(d)
+    dens=f.get("Density")
+    if dens is not None and len(dens):
+        dens=child_fields(dens).get("Default")
+    layer={"Description":leaf_value(f["Description"]) if "Description" in f else None,
+           "Thickness":leaf_value(f["Thickness"]) if "Thickness" in f else None,
+           "Density":leaf_value(dens) if dens is not None else None,
+           "Elements":[]}
+    for k,v in f.items():
+        if k.startswith("Element_") and len(v):
+            ef=child_fields(v)
+            gi=ef.get("GlobalElementIndex"); conc=ef.get("StartConcentration")
+            layer["Elements"].append((leaf_value(gi) if gi is not None else None,
+                                      leaf_value(conc) if conc is not None else "?"))
+    return layer
+
+BLOCK_CONVERTERS={"TXS2_XADFMgr_Info":element_to_dict,"TXS2_XADFMgr_MParam":element_to_dict,
+                  "TXS2_XADFMgr_CalcParam":element_to_dict,"TXS2_XADFMgr_SingleElement":element_to_dict,
+                  "TXS2_XADFMgr_SingleLayer":extract_single_layer}
+
+def collect_class_instances(source,guard=None):
+    """Single streaming pass over the XML: {Type: [converted ClassInstance, ...]} in document order.
+
+    Collected types may nest (e.g. a SingleElement inside MParam); each one is converted with its
+    full subtree. guard(elem,convert), if given, wraps each conversion (e.g. to record errors).
+    """
+    dispatch={t:([],fn) for t,fn in BLOCK_CONVERTERS.items()}
+    if HAVE_LXML:
+        events=ET.iterparse(source,events=("start","end"),tag="ClassInstance",
+                            huge_tree=True,remove_blank_text=True,remove_comments=True,remove_pis=True)
+    else:
+        events=ET.iterparse(source,events=("start","end"))
+    open_blocks=[]  # (bucket, slot, convert) of collected ClassInstances not yet closed
+    for ev,elem in events:
+        if elem.tag!=CLASS_INSTANCE: continue
+        entry=dispatch.get(elem.get("Type"))
+        if entry is None: continue
+        bucket,convert=entry
+        if ev=="start":
+            # reserve the slot now so nested blocks keep the pre-order of the old .// queries
+            bucket.append(None); open_blocks.append((bucket,len(bucket)-1,convert))
+            continue
+        bucket,slot,convert=open_blocks.pop()
+        bucket[slot]=guard(elem,convert) if guard else convert(elem)
+        if open_blocks: continue  # an enclosing collected block still needs this subtree
+        # drop the handled subtree (and, under lxml, everything before it) so the DOM doesn't accumulate
+        elem.clear()
+        if HAVE_LXML:
+            while elem.getprevious() is not None: del elem.getparent()[0]
+    return {t:bucket for t,(bucket,_) in dispatch.items()}
+
+def parse_xadf(source):
+    blocks=collect_class_instances(source)
+    data={}
+    if blocks["TXS2_XADFMgr_Info"]: data["Info"]=blocks["TXS2_XADFMgr_Info"][0]
+    mdata={}
+    if blocks["TXS2_XADFMgr_MParam"]:
+        mdata=blocks["TXS2_XADFMgr_MParam"][0].get("MParam",{})
+        if (z:=mdata.get("TubeZ")) and z.isdigit(): mdata["TubeElement"]=element_symbol(z)
+        if (atm:=mdata.get("Atmosphere")) in ATMOSPHERE_MAP: mdata["AtmosphereName"]=ATMOSPHERE_MAP[atm]
+    data["MeasurementParameters"]=mdata
+    if blocks["TXS2_XADFMgr_CalcParam"]:
+        data["CalculationParameters"]=blocks["TXS2_XADFMgr_CalcParam"][0].get("CalculationParameters",{})
+    # elements
+    lookup={}
+    for i,ed in enumerate(blocks["TXS2_XADFMgr_SingleElement"]):
+        se=next(iter(ed.values())) if ed else {}
+        if (z:=se.get("Z")) and z.isdigit(): se["ElementSymbol"]=element_symbol(z)
+        for k,v in se.items():
+            if isinstance(v,dict) and "UsedLines" in v: v["EmissionLines"]=translate_used_lines(v["UsedLines"])
+        lookup[i]=se
+    data["Elements"]=list(lookup.values())
+    # layers
+    layers=[]
+    for i,d in enumerate(blocks["TXS2_XADFMgr_SingleLayer"],1):
+        if not d: continue
+        info={"Index":i,"Description":d["Description"],
+              "Thickness_um":d["Thickness"],
+              "Density_gcm3":d["Density"],
+              "Elements":[]}
+        for gi,conc in d["Elements"]:
+            ei=lookup.get(int(gi)) if gi and gi.isdigit() else {}
+            sym=ei.get("ElementSymbol","?")
+            lines=[]
+            for sub in ei.values():
+                if isinstance(sub,dict) and "EmissionLines" in sub: lines=sub["EmissionLines"]
+            info["Elements"].append({"Symbol":sym,"Conc":conc,"Lines":lines})
+        layers.append(info)
+    data["Layers"]=layers
+    return data
+
+# ---------- Safe Parser ----------
+def parse_xadf_safe(source):
+    """Completely fault-tolerant XADF parser with extended metadata extraction."""
+    parsed = {
+        "Info": {},
+        "MeasurementParameters": {},
+        "CalculationParameters": {},
+        "Elements": [],
+        "Layers": [],
+        "_errors": []
+    }
+
+    def safe_get_dict(elem, convert=element_to_dict):
+        try:
+            return convert(elem) if elem is not None else {}
+        except Exception as e:
+            parsed["_errors"].append(str(e))
+            return {}
+
+    # conversion errors are recorded per block; malformed XML still raises to the caller
+    blocks = collect_class_instances(source, safe_get_dict)
+
+    # --- Info section ---
+    try:
+        if blocks["TXS2_XADFMgr_Info"]:
+            info_dict = blocks["TXS2_XADFMgr_Info"][0]
+            parsed["Info"] = info_dict
+
+            # Extract key fields from Info
+            info_data = info_dict.get("Info", info_dict)
+            parsed["InfoExtracted"] = {
+                "SpectrumProcessingType": info_data.get("SpectrumProcessingType"),
+                "AnalysisMethod": info_data.get("AnalysisMethod"),
+                "ModifyDate": info_data.get("ModifyDate"),
+                "ModifyDateSerialData": info_data.get("ModifyDateSerialData"),
+                "CalibDate": info_data.get("CalibDate"),
+                "CalibDateSerialData": info_data.get("CalibDateSerialData")
+            }
+    except Exception as e:
+        parsed["_errors"].append(f"Info section: {e}")
+
+    # --- Measurement parameters ---
+    try:
+        if blocks["TXS2_XADFMgr_MParam"]:
+            mdata = blocks["TXS2_XADFMgr_MParam"][0]
+            mp = mdata.get("MParam", mdata)
+            z = mp.get("TubeZ")
+            if z and z.isdigit():
+                mp["TubeElement"] = element_symbol(z)
+            atm = mp.get("Atmosphere")
+            if atm in ATMOSPHERE_MAP:
+                mp["AtmosphereName"] = ATMOSPHERE_MAP[atm]
+            parsed["MeasurementParameters"] = mp
+
+            # Extract UnitType and DetectorType
+            parsed["MeasurementMeta"] = {
+                "UnitType": mp.get("UnitType"),
+                "DetectorType": mp.get("DetectorType")
+            }
+    except Exception as e:
+        parsed["_errors"].append(f"Measurement parameters: {e}")
+
+    # --- Calculation parameters ---
+    try:
+        if blocks["TXS2_XADFMgr_CalcParam"]:
+            cdata = blocks["TXS2_XADFMgr_CalcParam"][0]
+            parsed["CalculationParameters"] = cdata.get("CalculationParameters", cdata)
+    except Exception as e:
+        parsed["_errors"].append(f"Calculation parameters: {e}")
+
+    # --- Elements (same as before) ---
+    try:
+        elements = []
+        for ed in blocks["TXS2_XADFMgr_SingleElement"]:
+            if not ed: continue
+            se = next(iter(ed.values())) if len(ed)==1 and list(ed.keys())[0].startswith("SingleElement_") else ed
+            if not isinstance(se,dict): continue
+            z = se.get("Z")
+            if z and z.isdigit(): se["ElementSymbol"]=element_symbol(z)
+            pe_num=None
+            for v in se.values():
+                if isinstance(v,dict) and "PE_Spc_Number" in v:
+                    pe_num=v["PE_Spc_Number"]; break
+            se["PE_Spc_Number"]=pe_num or "?"
+            for v in se.values():
+                if isinstance(v,dict) and "UsedLines" in v:
+                    v["EmissionLines"]=translate_used_lines(v["UsedLines"])
+            elements.append(se)
+        parsed["Elements"]=elements
+    except Exception as e:
+        parsed["_errors"].append(f"Elements: {e}")
+
+    # --- Layers (same as before) ---
+    try:
+        layers=[]
+        for i,lname in enumerate(blocks["TXS2_XADFMgr_SingleLayer"],1):
+            if not lname: continue
+            layer_info={"Index":i,
+                        "Description":lname["Description"],
+                        "Thickness_um":lname["Thickness"],
+                        "Density_gcm3":lname["Density"],
+                        "Elements":[]}
+            for gi,conc in lname["Elements"]:
+                ei=None
+                try: ei=parsed["Elements"][int(gi)]
+                except Exception: ei={}
+                sym=ei.get("ElementSymbol","?")
+                pe=ei.get("PE_Spc_Number","?")
+                lines=[]
+                for sub in ei.values():
+                    if isinstance(sub,dict) and "EmissionLines" in sub:
+                        lines=sub["EmissionLines"]
+                layer_info["Elements"].append({
+                    "Symbol":sym,
+                    "Conc":conc,
+                    "PE_Spc_Number":pe,
+                    "Lines":lines
+                })
+            layers.append(layer_info)
+        parsed["Layers"]=layers
+    except Exception as e:
+        parsed["_errors"].append(f"Layers: {e}")
+
+    return parsed
+
+# ---------- cached loaders ----------
+# shared by every page: one cache namespace, keyed by the uploaded bytes and parser flavour
+@st.cache_data(show_spinner="Parsing XADF…",max_entries=16)
+def load_cached(raw,safe=False):
+    return (parse_xadf_safe if safe else parse_xadf)(io.BytesIO(raw))
+
+@st.cache_data(max_entries=16)
+def dump_cached(raw,safe=False):
+    # serialized once per upload, not on every widget rerun
+    return dumps_json(load_cached(raw,safe))
+
+# ---------- visualization data ----------
+def _cell(v):
+    return v if v is None or isinstance(v,str) else str(v)
+
+def layer_table(elements,pe_number=False):
+    """Per-layer element table built straight as Arrow, which is what st.dataframe serializes anyway."""
+    cols={"Symbol":[e.get("Symbol","?") for e in elements],
+          "Conc":[e.get("Conc","?") for e in elements]}
+    if pe_number: cols["PE_Spc_Number"]=[e.get("PE_Spc_Number","?") for e in elements]
+    cols["Emission Lines"]=[", ".join(e.get("Lines",[])) for e in elements]
+    # typed string: a field whose XML node has children arrives as a dict, which Arrow inference rejects
+    return pa.table({k:pa.array([_cell(v) for v in vals],type=pa.string()) for k,vals in cols.items()})
+
+MAX_BAR_CELLS=200     # Layer x Element combinations before the stacked bar gets lumped
+MAX_BAR_ELEMENTS=12   # element series kept when it does
+
+def lump_minor_elements(df,yfield):
+    """Keep the largest elements as their own bar series and fold the rest into "Other"."""
+    if df["Element"].nunique()*df["Layer"].nunique()<=MAX_BAR_CELLS: return df
+    keep=df.groupby("Element")[yfield].sum().nlargest(MAX_BAR_ELEMENTS).index
+    out=df[["Layer","Element",yfield]].copy()
+    out.loc[~out["Element"].isin(keep),"Element"]="Other"
+    return out.groupby(["Layer","Element"],as_index=False,sort=False)[yfield].sum()
+
+@st.cache_data(max_entries=16)
+def build_viz_df(raw,safe=False):
+    # keyed on the upload bytes like load_cached; hashing the parsed dict would cost more than the build
+    # columnar build: one list per column, one numeric cast per column
+    layer_col,elem_col,conc_col,thick_col=[],[],[],[]
+    for L in load_cached(raw,safe).get("Layers",[]):
+        desc=L.get("Description",f"Layer {L['Index']}")
+        th=L.get("Thickness_um")
+        for e in L.get("Elements",[]):
+            layer_col.append(desc); elem_col.append(e.get("Symbol","?"))
+            conc_col.append(e.get("Conc")); thick_col.append(th)
+    return pd.DataFrame({
+        "Layer":layer_col,"Element":elem_col,
+        "Conc":pd.to_numeric(pd.Series(conc_col,dtype=object),errors="coerce").fillna(0.0).astype(float),
+        "Thickness":pd.to_numeric(pd.Series(thick_col,dtype=object),errors="coerce").fillna(0.0).astype(float)})
@@ -1,171 +1,37 @@
 import streamlit as st
-import xml.etree.ElementTree as ET
-import json
-import pandas as pd
+import numpy as np
 import plotly.express as px
 
-# ---------- helpers ----------
-ELEMENTS = {i:s for i,s in enumerate((
-"H","He","Li","Be","B","C","N","O","F","Ne","Na","Mg","Al","Si","P","S","Cl","Ar",
-"K","Ca","Sc","Ti","V","Cr","Mn","Fe","Co","Ni","Cu","Zn","Ga","Ge","As","Se","Br","Kr",
-"Rb","Sr","Y","Zr","Nb","Mo","Tc","Ru","Rh","Pd","Ag","Cd","In","Sn","Sb","Te","I","Xe",
-"Cs","Ba","La","Ce","Pr","Nd","Pm","Sm","Eu","Gd","Tb","Dy","Ho","Er","Tm","Yb","Lu",
-"Hf","Ta","W","Re","Os","Ir","Pt","Au","Hg","Tl","Pb","Bi","Po","At","Rn","Fr","Ra","Ac",
-"Th","Pa","U"
-), start=1)}
-LINE_MAP = {3:"K_alpha1",4:"K_alpha2",5:"K_beta2",6:"K_beta1",8:"K_beta3",9:"K_beta5",
-            12:"L_alpha1",14:"L_beta1",15:"L_beta2",17:"L_gamma1"}
-ATMOSPHERE_MAP = {"0":"Vacuum","1":"Air","2":"Helium"}
+from xadf_core import build_viz_df, dump_cached, dumps_json, layer_table, load_cached, lump_minor_elements
 
-def translate_used_lines(s):
-    if not s: return []
-    try: return [LINE_MAP.get(int(x),f"Line{x}") for x in s.split(",") if x.strip()]
-    except: return []
-
-def element_to_dict(elem):
-    d={}
-    for c in elem:
-        if c.tag=="ClassInstance":
-            for sub in c: d[sub.tag]=element_to_dict(sub)
-            continue
-        d[c.tag]=element_to_dict(c) if len(c) else (c.text.strip() if c.text else None)
-    return d
-
-# ---------- Safe Parser ----------
-def parse_xadf_safe(root):
-    """Completely fault-tolerant XADF parser with extended metadata extraction."""
-    parsed = {
-        "Info": {},
-        "MeasurementParameters": {},
-        "CalculationParameters": {},
-        "Elements": [],
-        "Layers": [],
-        "_errors": []
+@st.cache_data(max_entries=16)
+def _summary_dump(raw):
+    parsed=load_cached(raw,safe=True)
+    summary={
+        "SampleName":parsed.get("Info",{}).get("Info",{}).get("APLName","Unknown Sample"),
+        "MeasurementConditions":parsed.get("MeasurementParameters",{}),
+        "Layers":parsed.get("Layers",[]),
+        "CalculationParameters":parsed.get("CalculationParameters",{})
     }
-
-    def safe_get_dict(elem):
-        try:
-            return element_to_dict(elem) if elem is not None else {}
-        except Exception as e:
-            parsed["_errors"].append(str(e))
-            return {}
-
-    # --- Info section ---
-    try:
-        info_block = root.find(".//ClassInstance[@Type='TXS2_XADFMgr_Info']")
-        if info_block is not None:
-            info_dict = safe_get_dict(info_block)
-            parsed["Info"] = info_dict
-
-            # Extract key fields from Info
-            info_data = info_dict.get("Info", info_dict)
-            parsed["InfoExtracted"] = {
-                "SpectrumProcessingType": info_data.get("SpectrumProcessingType"),
-                "AnalysisMethod": info_data.get("AnalysisMethod"),
-                "ModifyDate": info_data.get("ModifyDate"),
-                "ModifyDateSerialData": info_data.get("ModifyDateSerialData"),
-                "CalibDate": info_data.get("CalibDate"),
-                "CalibDateSerialData": info_data.get("CalibDateSerialData")
-            }
-    except Exception as e:
-        parsed["_errors"].append(f"Info section: {e}")
-
-    # --- Measurement parameters ---
-    try:
-        m = root.find(".//ClassInstance[@Type='TXS2_XADFMgr_MParam']")
-        if m is not None:
-            mdata = safe_get_dict(m)
-            mp = mdata.get("MParam", mdata)
-            z = mp.get("TubeZ")
-            if z and z.isdigit():
-                mp["TubeElement"] = ELEMENTS.get(int(z), "?")
-            atm = mp.get("Atmosphere")
-            if atm in ATMOSPHERE_MAP:
-                mp["AtmosphereName"] = ATMOSPHERE_MAP[atm]
-            parsed["MeasurementParameters"] = mp
-
-            # Extract UnitType and DetectorType
-            parsed["MeasurementMeta"] = {
-                "UnitType": mp.get("UnitType"),
-                "DetectorType": mp.get("DetectorType")
-            }
-    except Exception as e:
-        parsed["_errors"].append(f"Measurement parameters: {e}")
-
-    # --- Calculation parameters ---
-    try:
-        calc = root.find(".//ClassInstance[@Type='TXS2_XADFMgr_CalcParam']")
-        if calc is not None:
-            cdata = safe_get_dict(calc)
-            parsed["CalculationParameters"] = cdata.get("CalculationParameters", cdata)
-    except Exception as e:
-        parsed["_errors"].append(f"Calculation parameters: {e}")
-
-    # --- Elements (same as before) ---
-    try:
-        elements = []
-        for e in root.findall(".//ClassInstance[@Type='TXS2_XADFMgr_SingleElement']"):
-            ed = safe_get_dict(e)
-            if not ed: continue
-            se = next(iter(ed.values())) if len(ed)==1 and list(ed.keys())[0].startswith("SingleElement_") else ed
-            if not isinstance(se,dict): continue
-            z = se.get("Z")
-            if z and z.isdigit(): se["ElementSymbol"]=ELEMENTS.get(int(z),"?")
-            pe_num=None
-            for v in se.values():
-                if isinstance(v,dict) and "PE_Spc_Number" in v:
-                    pe_num=v["PE_Spc_Number"]; break
-            se["PE_Spc_Number"]=pe_num or "?"
-            for v in se.values():
-                if isinstance(v,dict) and "UsedLines" in v:
-                    v["EmissionLines"]=translate_used_lines(v["UsedLines"])
-            elements.append(se)
-        parsed["Elements"]=elements
-    except Exception as e:
-        parsed["_errors"].append(f"Elements: {e}")
-
-    # --- Layers (same as before) ---
-    try:
-        layers=[]
-        for i,lyr in enumerate(root.findall(".//ClassInstance[@Type='TXS2_XADFMgr_SingleLayer']"),1):
-            L=safe_get_dict(lyr)
-            if not L: continue
-            lname=next(iter(L.values())) if isinstance(L,dict) and len(L) else L
-            if not isinstance(lname,dict): continue
-            layer_info={"Index":i,
-                        "Description":lname.get("Description"),
-                        "Thickness_um":lname.get("Thickness"),
-                        "Density_gcm3":lname.get("Density",{}).get("Default")
-                            if isinstance(lname.get("Density"),dict) else lname.get("Density"),
-                        "Elements":[]}
-            for key,val in lname.items():
-                if key.startswith("Element_") and isinstance(val,dict):
-                    gi=val.get("GlobalElementIndex")
-                    ei=None
-                    try: ei=parsed["Elements"][int(gi)]
-                    except Exception: ei={}
-                    sym=ei.get("ElementSymbol","?")
-                    conc=val.get("StartConcentration","?")
-                    pe=ei.get("PE_Spc_Number","?")
-                    lines=[]
-                    for sub in ei.values():
-                        if isinstance(sub,dict) and "EmissionLines" in sub:
-                            lines=sub["EmissionLines"]
-                    layer_info["Elements"].append({
-                        "Symbol":sym,
-                        "Conc":conc,
-                        "PE_Spc_Number":pe,
-                        "Lines":lines
-                    })
-            layers.append(layer_info)
-        parsed["Layers"]=layers
-    except Exception as e:
-        parsed["_errors"].append(f"Layers: {e}")
-
-    return parsed
+    return dumps_json(summary)
 
 
 # ---------- STREAMLIT APP ----------
+@st.fragment
+def _composition_fragment(df):
+    # toggling Normalize only reruns this block, not the parse or the layer tables
+    normalize=st.checkbox("Normalize layer concentrations (sum = 100 %)",value=False)
+    if normalize:
+        sums=df.groupby("Layer")["Conc"].transform("sum")
+        df=df.assign(Conc_norm=np.where(sums!=0,df["Conc"]/sums*100,df["Conc"]))
+        yfield,ytitle="Conc_norm","Normalized Concentration (%)"
+    else:
+        yfield,ytitle="Conc","Concentration (raw units)"
+    fig=px.bar(lump_minor_elements(df,yfield),x="Layer",y=yfield,color="Element",barmode="stack",
+               title="Layer Composition",text_auto=True)
+    fig.update_yaxes(title=ytitle)
+    st.plotly_chart(fig,use_container_width=True)
+
 st.set_page_config(page_title="Bruker XMethod XADF Viewer", layout="wide")
 st.title("🧪 Bruker XMethod XADF Summary Viewer")
 
@@ -174,9 +40,8 @@ debug_mode=st.checkbox("🔍 Enable debug mode (show raw XML / parser trace)",va
 
 if uploaded:
     try:
-        tree=ET.parse(uploaded)
-        root=tree.getroot()
-        parsed=parse_xadf_safe(root)
+        raw=uploaded.getvalue()
+        parsed=load_cached(raw,safe=True)
 
         # Error summary
         if parsed.get("_errors"):
@@ -233,57 +98,25 @@ if uploaded:
                 st.write(f"**Thickness:** {L.get('Thickness_um','?')} µm")
                 st.write(f"**Density:** {L.get('Density_gcm3','?')} g/cm³")
                 if L.get("Elements"):
-                    df=pd.DataFrame([{
-                        "Symbol":e.get("Symbol","?"),
-                        "Conc":e.get("Conc","?"),
-                        "PE_Spc_Number":e.get("PE_Spc_Number","?"),
-                        "Emission Lines":", ".join(e.get("Lines",[]))
-                    } for e in L["Elements"]])
-                    st.dataframe(df,use_container_width=True)
+                    st.dataframe(layer_table(L["Elements"],pe_number=True),use_container_width=True)
                 else:
                     st.info("No elements listed for this layer.")
 
         with st.expander("📊 Layer Composition (Stacked Bar)",expanded=True):
-            rows=[]
-            for L in parsed.get("Layers",[]):
-                desc=L.get("Description",f"Layer {L['Index']}")
-                for e in L.get("Elements",[]):
-                    try: conc=float(e.get("Conc",0) or 0)
-                    except: conc=0
-                    rows.append({"Layer":desc,"Element":e.get("Symbol","?"),"Conc":conc})
-            df=pd.DataFrame(rows)
+            df=build_viz_df(raw,safe=True)
             if df.empty:
                 st.info("No element data available for visualization.")
             else:
-                normalize=st.checkbox("Normalize layer concentrations (sum = 100 %)",value=False)
-                if normalize:
-                    df["Conc_norm"]=df.groupby("Layer")["Conc"].transform(
-                        lambda x:x/x.sum()*100 if x.sum()!=0 else x)
-                    yfield,ytitle="Conc_norm","Normalized Concentration (%)"
-                else:
-                    yfield,ytitle="Conc","Concentration (raw units)"
-                fig=px.bar(df,x="Layer",y=yfield,color="Element",barmode="stack",
-                           title="Layer Composition",text_auto=True)
-                fig.update_yaxes(title=ytitle)
-                st.plotly_chart(fig,use_container_width=True)
+                _composition_fragment(df)
 
         st.divider()
-        full_json=json.dumps(parsed,indent=2,ensure_ascii=False)
-        summary={
-            "SampleName":sample,
-            "MeasurementConditions":mp,
-            "Layers":parsed.get("Layers",[]),
-            "CalculationParameters":parsed.get("CalculationParameters",{})
-        }
-        summary_json=json.dumps(summary,indent=2,ensure_ascii=False)
-
         c1,c2=st.columns(2)
         with c1:
             st.download_button("💾 Save Full JSON (raw structure)",
-                data=full_json,file_name=f"{sample}_full.json",mime="application/json")
+                data=dump_cached(raw,safe=True),file_name=f"{sample}_full.json",mime="application/json")
         with c2:
             st.download_button("📘 Save Summary JSON",
-                data=summary_json,file_name=f"{sample}_summary.json",mime="application/json")
+                data=_summary_dump(raw),file_name=f"{sample}_summary.json",mime="application/json")
 
     except Exception as e:
         st.error(f"❌ Error while parsing file: {e}")